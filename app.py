@@ -4,23 +4,44 @@ app.py - FastAPI web API for professor review system
 """
 
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, ORJSONResponse, StreamingResponse
 from fastapi.exceptions import RequestValidationError
 from pydantic import BaseModel, Field
-from synthesizer import ProfessorSynthesizer
+from synthesizer import MAX_QUERY_LENGTH, ProfessorSynthesizer
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
 from fastapi.staticfiles import StaticFiles
 from slowapi.errors import RateLimitExceeded
+import asyncio
+import hashlib
+import orjson
 import os
+import re
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 from datetime import datetime
 
-limiter = Limiter(key_func=get_remote_address)
+# In-process counters by default; point RATE_LIMIT_STORAGE_URI at Redis (e.g. redis://localhost:6379)
+# so limits are shared across uvicorn workers and replicas
+limiter = Limiter(
+    key_func=get_remote_address,
+    storage_uri=os.environ.get("RATE_LIMIT_STORAGE_URI", "memory://")
+)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Create the synthesizer once at startup and share it across requests"""
+    app.state.synthesizer = ProfessorSynthesizer("data/professors.db")
+    yield
+    app.state.synthesizer.close()
 
 app = FastAPI(
     title="Cal Poly Professor Review API",
     description="AI-powered professor review analysis system for Cal Poly",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse  # orjson serializes responses instead of stdlib json
 )
 
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -40,10 +61,42 @@ async def validation_exception_handler(request: Request, exc: RequestValidationE
         }
     )
 
-synthesizer = ProfessorSynthesizer("data/professors.db")
+# Answers for recently seen queries, keyed by a hash of the normalized query text
+RESPONSE_CACHE_TTL = 3600  # seconds
+RESPONSE_CACHE_MAX_ENTRIES = 1024
+response_cache = OrderedDict()
+
+# Possessives and punctuation don't change what is being asked
+_CACHE_NORMALIZE_RE = re.compile(r"'s\b|[^\w\s]")
+
+def get_cache_key(query):
+    """Hash the query with case, punctuation, possessives and whitespace normalized"""
+    normalized = " ".join(_CACHE_NORMALIZE_RE.sub(" ", query.lower()).split())
+    return hashlib.blake2b(normalized.encode(), digest_size=16).hexdigest()
+
+def get_cached_response(key):
+    """Return a cached (response, tokens_used) pair, or None if missing or expired"""
+    entry = response_cache.get(key)
+    if entry is None:
+        return None
+    
+    expires_at, value = entry
+    if expires_at < time.monotonic():
+        del response_cache[key]
+        return None
+    
+    response_cache.move_to_end(key)
+    return value
+
+def cache_response(key, value):
+    """Store a (response, tokens_used) pair, evicting the least recently used entries"""
+    response_cache[key] = (time.monotonic() + RESPONSE_CACHE_TTL, value)
+    response_cache.move_to_end(key)
+    while len(response_cache) > RESPONSE_CACHE_MAX_ENTRIES:
+        response_cache.popitem(last=False)
 
 class QueryRequest(BaseModel):
-    query: str = Field(..., max_length=100, min_length=1)
+    query: str = Field(..., max_length=MAX_QUERY_LENGTH, min_length=1)
 
 class QueryResponse(BaseModel):
     query: str
@@ -57,7 +110,7 @@ async def home():
     return FileResponse("templates/index.html")
 
 @app.post("/api/query", response_model=QueryResponse)
-@limiter.limit("10/minute")  # 10 queries per minute per IP address
+@limiter.shared_limit("10/minute", scope="query")  # 10 queries per minute per IP address, streamed or not
 async def query_professor(request: Request, query_request: QueryRequest):
     """
     Query professor reviews using AI analysis
@@ -68,25 +121,66 @@ async def query_professor(request: Request, query_request: QueryRequest):
         if not query_request.query.strip():
             raise HTTPException(status_code=400, detail="Query cannot be empty")
         
-        response, tokens_used = synthesizer.process_query(query_request.query)
+        cache_key = get_cache_key(query_request.query)
+        cached = get_cached_response(cache_key)
         
-        return QueryResponse(
-            query=query_request.query,
-            response=response,
-            timestamp=datetime.now().isoformat(),
-            tokens_used=tokens_used
-        )
+        if cached:
+            response, tokens_used = cached[0], 0
+        else:
+            response, tokens_used = await request.app.state.synthesizer.process_query(query_request.query)
+            if "error" not in response:
+                cache_response(cache_key, (response, tokens_used))
+        
+        # Returned as a Response so FastAPI skips re-validating the nested dicts against QueryResponse,
+        # which stays as the documented schema
+        return ORJSONResponse({
+            "query": query_request.query,
+            "response": response,
+            "timestamp": datetime.now().isoformat(),
+            "tokens_used": tokens_used
+        })
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing query: {str(e)}")
 
+@app.post("/api/query/stream")
+@limiter.shared_limit("10/minute", scope="query")  # same budget as /api/query
+async def query_professor_stream(request: Request, query_request: QueryRequest):
+    """
+    Stream the answer as newline-delimited JSON
+    
+    - First line: professor, stats and excerpts (or an error)
+    - Following lines: {"delta": ...} pieces of the analysis as they are generated
+    """
+    if not query_request.query.strip():
+        raise HTTPException(status_code=400, detail="Query cannot be empty")
+    
+    async def events():
+        # The 200 status is already sent once the first line goes out, so errors become a final line
+        try:
+            async for event in request.app.state.synthesizer.process_query_stream(query_request.query):
+                yield orjson.dumps(event) + b"\n"
+        except Exception as e:
+            print(f"Stream error: {e}")
+            yield orjson.dumps({"error": f"Error processing query: {e}"}) + b"\n"
+    
+    return StreamingResponse(events(), media_type="application/x-ndjson")
+
 @app.get("/api/health")
-async def health_check():
+async def health_check(request: Request):
     """Health check endpoint"""
+    try:
+        await asyncio.wait_for(
+            asyncio.to_thread(request.app.state.synthesizer.check_database), timeout=0.5
+        )
+        database = "connected"
+    except Exception:
+        database = "degraded"
+    
     return {
-        "status": "healthy", 
+        "status": "healthy" if database == "connected" else "degraded", 
         "timestamp": datetime.now().isoformat(),
-        "database": "connected"
+        "database": database
     }
 
 if __name__ == "__main__":
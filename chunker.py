@@ -3,160 +3,342 @@
 chunk.py - Review chunking with database integration
 """
 
-import json
+import argparse
+import asyncio
+import orjson
 import re
-import sqlite3
-import tiktoken
 import os
-from openai import OpenAI
+from typing import List, Literal, get_args
+from openai import AsyncOpenAI
+from pydantic import BaseModel
 from dotenv import load_dotenv
+import db
 
 load_dotenv()
 
+_WS_RE = re.compile(r'\s+')
+
+Aspect = Literal["teaching_style", "grading_exams", "workload", "accessibility", "course_structure", "personality", "overall"]
+Sentiment = Literal["positive", "negative", "neutral"]
+
+PROMPT_TEMPLATE = """Extract aspects from this professor review: extract anything giving insight about professor including slang but not physical/inappropriate. Each chunk has the text discussing the aspect, the aspect and its sentiment.
+
+{review}"""
+
+# Structured output schema; the API guarantees responses match it
+CHUNKS_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "review_chunks",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "chunks": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "content": {"type": "string"},
+                            "aspect": {"type": "string", "enum": list(get_args(Aspect))},
+                            "sentiment": {"type": "string", "enum": list(get_args(Sentiment))}
+                        },
+                        "required": ["content", "aspect", "sentiment"],
+                        "additionalProperties": False
+                    }
+                }
+            },
+            "required": ["chunks"],
+            "additionalProperties": False
+        }
+    }
+}
+
+# The Batch API rejects input files with more requests than this
+BATCH_MAX_REQUESTS = 50000
+
+class ReviewChunk(BaseModel):
+    content: str
+    aspect: Aspect
+    sentiment: Sentiment
+
+class ReviewChunks(BaseModel):
+    chunks: List[ReviewChunk]
+
 class ReviewChunkProcessor:
-    def __init__(self, db_path):
+    def __init__(self, db_path, batch_size=50, max_concurrency=20):
         self.db_path = db_path
-        self.client = OpenAI(api_key=os.getenv("OPEN_AI_API_KEY"))
-        self.encoding = tiktoken.encoding_for_model("gpt-4o-mini")
+        self.client = AsyncOpenAI(api_key=os.getenv("OPEN_AI_API_KEY"))
+        self.batch_size = batch_size  # reviews gathered per round
+        self.max_concurrency = max_concurrency  # in-flight OpenAI requests
+        
+        # One connection for the whole run keeps the page cache warm across reviews
+        self.conn = db.connect(db_path, check_same_thread=False)
+        # Adds the content_hash column and unique index to databases created before them
+        db.ensure_schema(self.conn)
+    
+    def close(self):
+        db.close(self.conn)
     
     def _clean_text(self, text):
         if not text:
             return ""
-        return re.sub(r'\s+', ' ', text).replace('\\"', '"').replace("\\'", "'").strip().strip('"')
+        return _WS_RE.sub(' ', text).replace('\\"', '"').replace("\\'", "'").strip().strip('"')
     
-    def _chunk_review(self, review_text):
+    def _request_body(self, prompt):
+        return {
+            "model": "gpt-4o-mini",
+            "messages": [{"role": "user", "content": prompt}],
+            "temperature": 0.1,
+            "max_tokens": 1000,
+            "response_format": CHUNKS_RESPONSE_FORMAT
+        }
+    
+    async def _chunk_review(self, review_text):
         cleaned_text = self._clean_text(review_text)
         
-        prompt = f"""Extract aspects from this professor review. Return JSON array only: extract anything giving insight about professor including slang but not physical/inappropriate
-[{{"content": "text discussing aspect", "aspect": "teaching_style|grading_exams|workload|accessibility|course_structure|personality|overall", "sentiment": "positive|negative|neutral"}}]
-
-{cleaned_text}"""
-
-        tokens = len(self.encoding.encode(prompt))
+        prompt = PROMPT_TEMPLATE.format(review=cleaned_text)
         
         try:
-            response = self.client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[{"role": "user", "content": prompt}],
-                temperature=0.1,
-                max_tokens=1000
-            )
-            
-            tokens += response.usage.completion_tokens
-            content = response.choices[0].message.content.strip()
+            response = await self.client.chat.completions.create(**self._request_body(prompt))
             
-            if content.startswith('```json'):
-                content = content.replace('```json', '').replace('```', '').strip()
+            # Billed usage, including the response schema, matching what collect_batch stores
+            tokens = response.usage.total_tokens
+            content = response.choices[0].message.content
             
-            return json.loads(content), tokens, content
+            return self._parse_chunks(content), tokens, content
             
         except Exception as e:
             return [], 0, f"Error: {e}"
     
+    def _parse_chunks(self, content):
+        return ReviewChunks.model_validate_json(content).chunks
+    
     def _store_chunks(self, review_id, chunks_data, tokens):
+        """Queue chunk rows on the open transaction; process_reviews commits per batch"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                for chunk in chunks_data:
-                    conn.execute("""
-                        INSERT INTO review_chunks (review_id, aspect, content, sentiment, tokens_used)
-                        VALUES (?, ?, ?, ?, ?)
-                    """, (review_id, chunk['aspect'], chunk['content'], chunk['sentiment'], tokens))
+            rows = [(review_id, chunk.aspect, chunk.content, db.content_hash(chunk.content), chunk.sentiment, tokens)
+                    for chunk in chunks_data]
+            self.conn.executemany("""
+                INSERT INTO review_chunks (review_id, aspect, content, content_hash, sentiment, tokens_used)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(review_id, aspect, content_hash) DO NOTHING
+            """, rows)
             return True
         except Exception as e:
             print(f"Store error: {e}")
             return False
 
-    def _already_processed(self, review_id):
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT COUNT(*) FROM review_chunks WHERE review_id = ?", (review_id,))
-            return cursor.fetchone()[0] > 0
-
-    def process_reviews(self, professor_id=None, limit=None):
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            
-            if professor_id:
-                cursor.execute("""
-                    SELECT r.id, r.rating_text, p.first_name, p.last_name, r.course_code
-                    FROM reviews r
-                    JOIN professors p ON r.professor_id = p.id
-                    WHERE r.professor_id = ? AND r.rating_text IS NOT NULL AND r.rating_text != ''
-                """, (professor_id,))
-            else:
-                limit_clause = f"LIMIT {limit}" if limit else ""
-                cursor.execute(f"""
-                    SELECT r.id, r.rating_text, p.first_name, p.last_name, r.course_code
-                    FROM reviews r
-                    JOIN professors p ON r.professor_id = p.id
-                    WHERE r.rating_text IS NOT NULL AND r.rating_text != ''
-                    {limit_clause}
-                """)
-            
-            reviews = cursor.fetchall()
+    def _pending_reviews_query(self, professor_id=None, limit=None):
+        """Build the SELECT for reviews that have no chunks yet"""
+        query = """
+            SELECT r.id, r.rating_text, p.first_name, p.last_name, r.course_code
+            FROM reviews r
+            JOIN professors p ON r.professor_id = p.id
+            WHERE r.rating_text IS NOT NULL AND r.rating_text != ''
+              AND NOT EXISTS (SELECT 1 FROM review_chunks c WHERE c.review_id = r.id)
+        """
+        params = []
         
-        if not reviews:
+        if professor_id:
+            query += " AND r.professor_id = ?"
+            params.append(professor_id)
+        
+        if limit:
+            query += " LIMIT ?"
+            params.append(limit)
+        
+        return query, params
+    
+    def _has_chunks(self, review_id):
+        """Same test as the NOT EXISTS in _pending_reviews_query, for a single review"""
+        return self.conn.execute(
+            "SELECT EXISTS (SELECT 1 FROM review_chunks c WHERE c.review_id = ?)", (review_id,)
+        ).fetchone()[0]
+    
+    async def process_reviews(self, professor_id=None, limit=None):
+        query, params = self._pending_reviews_query(professor_id, limit)
+        
+        # Count up front for progress output, then stream rows batch by batch
+        total = self.conn.execute(f"SELECT COUNT(*) FROM ({query})", params).fetchone()[0]
+        
+        if not total:
             return {"processed": 0, "failed": 0, "total": 0, "tokens": 0}
         
+        cursor = self.conn.execute(query, params)
+        
         processed = failed = total_tokens = 0
+        sem = asyncio.Semaphore(self.max_concurrency)
+        
+        async def worker(review):
+            async with sem:
+                return await self._chunk_review(review[1])
         
-        with open("chunking.log", "w", encoding="utf-8", newline='\n') as log_file:
-            log_file.write(f"Processing {len(reviews)} reviews\n\n")
+        with open("chunking.log", "w", encoding="utf-8", newline='\n') as log_file, \
+             open("chunking_failures.log", "a", encoding="utf-8", newline='\n') as fail_log:
+            log_file.write(f"Processing {total} reviews\n\n")
             
-            for i, (review_id, text, first_name, last_name, course) in enumerate(reviews):
-                professor = f"{first_name} {last_name}"
-                
-                print(f"[{i+1}/{len(reviews)}] {professor} ({course or 'N/A'})")
-                log_file.write(f"[{i+1}/{len(reviews)}] {professor} ({course or 'N/A'})\n")
-                log_file.write(f"Review ID: {review_id}\n")
-                log_file.write(f"Original text: {text}\n")
-                
-                if self._already_processed(review_id):
-                    print("Already processed - skipping")
-                    log_file.write("Already processed - skipping\n\n")
-                    processed += 1
-                    continue
-                
-                chunks_data, tokens, llm_response = self._chunk_review(text)
+            start = 0
+            while rows := cursor.fetchmany(self.batch_size):
+                batch = list(enumerate(rows, start))
+                start += len(rows)
+                results = await asyncio.gather(*[worker(review) for _, review in batch])
                 
-                log_file.write(f"Full LLM response: {llm_response}\n")
-                
-                if chunks_data and self._store_chunks(review_id, chunks_data, tokens):
-                    processed += 1
-                    total_tokens += tokens
-                    msg = f"{len(chunks_data)} chunks, {tokens} tokens"
-                    print(msg)
-                    log_file.write(f"SUCCESS: {msg}\n")
-                else:
-                    failed += 1
-                    print("Failed")
-                    log_file.write("FAILED\n")
+                for (i, (review_id, text, first_name, last_name, course)), (chunks_data, tokens, llm_response) in zip(batch, results):
+                    professor = f"{first_name} {last_name}"
                     
-                    # Log failures to separate file
-                    with open("chunking_failures.log", "a", encoding="utf-8", newline='\n') as fail_log:
-                        fail_log.write(f"[{i+1}/{len(reviews)}] {professor} ({course or 'N/A'})\n")
+                    print(f"[{i+1}/{total}] {professor} ({course or 'N/A'})")
+                    log_file.write(f"[{i+1}/{total}] {professor} ({course or 'N/A'})\n")
+                    log_file.write(f"Review ID: {review_id}\n")
+                    log_file.write(f"Original text: {text}\n")
+                    log_file.write(f"Full LLM response: {llm_response}\n")
+                    
+                    if chunks_data and self._store_chunks(review_id, chunks_data, tokens):
+                        processed += 1
+                        total_tokens += tokens
+                        msg = f"{len(chunks_data)} chunks, {tokens} tokens"
+                        print(msg)
+                        log_file.write(f"SUCCESS: {msg}\n")
+                    else:
+                        failed += 1
+                        print("Failed")
+                        log_file.write("FAILED\n")
+                        
+                        # Log failures to separate file
+                        fail_log.write(f"[{i+1}/{total}] {professor} ({course or 'N/A'})\n")
                         fail_log.write(f"Review ID: {review_id}\n")
                         fail_log.write(f"Original text: {text}\n")
                         fail_log.write(f"Full LLM response: {llm_response}\n")
                         fail_log.write("="*80 + "\n\n")
+                    
+                    log_file.write("\n" + "="*80 + "\n\n")
+                
+                # One commit (and fsync) per batch instead of per review
+                self.conn.commit()
+                log_file.flush()
+                fail_log.flush()
+        
+        return {"processed": processed, "failed": failed, "total": total, "tokens": total_tokens}
+    
+    async def submit_batch(self, professor_id=None, limit=None, batch_file="chunking_batch.jsonl"):
+        """Submit pending reviews as OpenAI Batch API jobs of at most BATCH_MAX_REQUESTS each. Returns the batch ids"""
+        query, params = self._pending_reviews_query(professor_id, limit)
+        cursor = self.conn.execute(query, params)
+        
+        batch_ids = []
+        stem, ext = os.path.splitext(batch_file)
+        
+        while rows := cursor.fetchmany(BATCH_MAX_REQUESTS):
+            part_file = f"{stem}_{len(batch_ids) + 1}{ext}"
+            with open(part_file, "wb") as f:
+                for review_id, text, *_ in rows:
+                    prompt = PROMPT_TEMPLATE.format(review=self._clean_text(text))
+                    f.write(orjson.dumps({
+                        "custom_id": review_id,
+                        "method": "POST",
+                        "url": "/v1/chat/completions",
+                        "body": self._request_body(prompt)
+                    }) + b"\n")
+            
+            with open(part_file, "rb") as f:
+                uploaded = await self.client.files.create(file=f, purpose="batch")
+            
+            batch = await self.client.batches.create(
+                input_file_id=uploaded.id,
+                endpoint="/v1/chat/completions",
+                completion_window="24h"
+            )
+            print(f"Submitted batch {batch.id} with {len(rows)} reviews")
+            batch_ids.append(batch.id)
+        
+        return batch_ids
+    
+    async def collect_batch(self, batch_id):
+        """Store the chunks from a finished batch job"""
+        batch = await self.client.batches.retrieve(batch_id)
+        if batch.status != "completed":
+            return {"status": batch.status}
+        
+        processed = failed = skipped = total_tokens = 0
+        
+        with open("chunking_failures.log", "a", encoding="utf-8", newline='\n') as fail_log:
+            # A batch where every request failed has an error file and no output file
+            if batch.output_file_id:
+                output = await self.client.files.content(batch.output_file_id)
                 
-                log_file.write("\n" + "="*80 + "\n\n")
+                for line in output.content.splitlines():
+                    result = orjson.loads(line)
+                    review_id = result["custom_id"]
+                    response = result.get("response") or {}
+                    
+                    # Chunked interactively while the batch was running; keep the existing chunks
+                    if self._has_chunks(review_id):
+                        skipped += 1
+                        continue
+                    
+                    try:
+                        body = response["body"]
+                        content = body["choices"][0]["message"]["content"]
+                        tokens = body["usage"]["total_tokens"]
+                        chunks_data = self._parse_chunks(content)
+                    except Exception as e:
+                        content, tokens, chunks_data = f"Error: {result.get('error') or e}", 0, []
+                    
+                    if chunks_data and self._store_chunks(review_id, chunks_data, tokens):
+                        processed += 1
+                        total_tokens += tokens
+                    else:
+                        failed += 1
+                        fail_log.write(f"Review ID: {review_id}\n")
+                        fail_log.write(f"Full LLM response: {content}\n")
+                        fail_log.write("="*80 + "\n\n")
+            
+            if batch.error_file_id:
+                errors = await self.client.files.content(batch.error_file_id)
                 
-                if (i + 1) % 100 == 0:
-                    log_file.flush()
+                for line in errors.content.splitlines():
+                    result = orjson.loads(line)
+                    error = result.get("error") or (result.get("response") or {}).get("body")
+                    failed += 1
+                    fail_log.write(f"Review ID: {result.get('custom_id')}\n")
+                    fail_log.write(f"Batch error: {error}\n")
+                    fail_log.write("="*80 + "\n\n")
         
-        return {"processed": processed, "failed": failed, "total": len(reviews), "tokens": total_tokens}
+        self.conn.commit()
+        
+        return {"status": batch.status, "processed": processed, "failed": failed, "skipped": skipped, "tokens": total_tokens}
+    
+    async def collect_batches(self, batch_ids):
+        """Collect several batches in turn on one event loop, which the client's connection pool is bound to"""
+        return [(batch_id, await self.collect_batch(batch_id)) for batch_id in batch_ids]
     
 def main():
-    processor = ReviewChunkProcessor("data/professors.db")
+    parser = argparse.ArgumentParser(description="Split reviews into aspect chunks with OpenAI")
     
-    # Process all reviews
-    result = processor.process_reviews()
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--batch-submit', action='store_true', help='Submit pending reviews as an OpenAI Batch API job (cheaper, results within 24h)')
+    group.add_argument('--batch-collect', type=str, nargs='+', metavar='BATCH_ID', help='Store the results of finished batch jobs')
+    parser.add_argument('--prof', type=str, metavar='ID', help='Only process reviews for this professor ID')
+    parser.add_argument('--limit', type=int, help='Maximum number of reviews to process')
     
-    # Or process specific professor
-    #result = processor.process_reviews(professor_id="88de09b4-443f-4b32-b428-92c6aa35952e")
+    args = parser.parse_args()
     
-    print(f"Results: {result['processed']}/{result['total']} processed, {result['tokens']} tokens")
+    processor = ReviewChunkProcessor("data/professors.db")
+    
+    try:
+        if args.batch_submit:
+            batch_ids = asyncio.run(processor.submit_batch(professor_id=args.prof, limit=args.limit))
+            print(f"Collect later with: python chunker.py --batch-collect {' '.join(batch_ids)}" if batch_ids else "No pending reviews")
+        
+        elif args.batch_collect:
+            for batch_id, result in asyncio.run(processor.collect_batches(args.batch_collect)):
+                print(f"Batch {batch_id} results: {result}")
+        
+        else:
+            result = asyncio.run(processor.process_reviews(professor_id=args.prof, limit=args.limit))
+            print(f"Results: {result['processed']}/{result['total']} processed, {result['tokens']} tokens")
+    finally:
+        processor.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,150 @@
+"""
+db.py - Shared SQLite connection setup and schema
+"""
+
+import hashlib
+import os
+import sqlite3
+import time
+from pathlib import Path
+
+# busy_timeout makes a connection wait out another's write lock instead of failing at once
+READ_PRAGMAS = """
+    PRAGMA temp_store=MEMORY;
+    PRAGMA cache_size=-65536;
+    PRAGMA mmap_size=268435456;
+    PRAGMA busy_timeout=5000;
+"""
+
+# WAL lets readers and the single writer run side by side and only fsyncs at checkpoints
+PRAGMAS = """
+    PRAGMA journal_mode=WAL;
+    PRAGMA synchronous=NORMAL;
+""" + READ_PRAGMAS
+
+TABLES = """
+    CREATE TABLE IF NOT EXISTS professors (
+        id TEXT PRIMARY KEY,
+        first_name TEXT,
+        last_name TEXT,
+        department TEXT,
+        overall_rating REAL,
+        material_clear REAL,
+        student_difficulties REAL,
+        num_evals INTEGER,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    
+    CREATE TABLE IF NOT EXISTS courses (
+        code TEXT PRIMARY KEY,
+        name TEXT,
+        department TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    
+    CREATE TABLE IF NOT EXISTS reviews (
+        id TEXT PRIMARY KEY,
+        professor_id TEXT,
+        course_code TEXT,
+        grade TEXT,
+        grade_level TEXT,
+        course_type TEXT,
+        rating_text TEXT,
+        post_date TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (professor_id) REFERENCES professors (id),
+        FOREIGN KEY (course_code) REFERENCES courses (code)
+    );
+    
+    CREATE TABLE IF NOT EXISTS fetch_logs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        action TEXT,
+        status TEXT,
+        message TEXT,
+        professor_id TEXT,
+        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    
+    CREATE TABLE IF NOT EXISTS review_chunks (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        review_id TEXT,
+        aspect TEXT,
+        content TEXT,
+        content_hash BLOB,
+        sentiment TEXT,
+        tokens_used INTEGER,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (review_id) REFERENCES reviews (id)
+    );
+    
+    CREATE VIRTUAL TABLE IF NOT EXISTS professors_fts USING fts5(
+        name, 
+        professor_id
+    );
+"""
+
+# The only place indexes are defined; they ship in data/professors.db, so the web app never creates them
+INDEXES = """
+    CREATE INDEX IF NOT EXISTS idx_profs_lastname ON professors(last_name COLLATE NOCASE);
+    CREATE INDEX IF NOT EXISTS idx_reviews_prof_course ON reviews(professor_id, course_code COLLATE NOCASE);
+    CREATE UNIQUE INDEX IF NOT EXISTS uq_review_chunks_hash ON review_chunks(review_id, aspect, content_hash);
+    
+    -- Superseded by uq_review_chunks_hash, which has the same leading columns
+    DROP INDEX IF EXISTS idx_chunks_review_aspect;
+"""
+
+def connect(db_path, readonly=False, **kwargs):
+    """Open a connection to db_path with the project's PRAGMAs applied; a readonly one never writes the file"""
+    if readonly:
+        conn = sqlite3.connect(Path(db_path).absolute().as_uri() + "?mode=ro", uri=True, **kwargs)
+        conn.executescript(READ_PRAGMAS)
+        return conn
+    
+    conn = sqlite3.connect(db_path, **kwargs)
+    conn.executescript(PRAGMAS)
+    return conn
+
+# WAL mode is stored in the file itself, and a WAL database can't be opened read-only from a
+# read-only directory without its -wal/-shm files, so writers hand the tracked file back in DELETE mode
+def close(conn):
+    """Commit, checkpoint and switch back to a rollback journal, then close"""
+    conn.commit()
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.execute("PRAGMA journal_mode=DELETE")
+    conn.close()
+
+def ensure_schema(conn):
+    """Create missing tables and indexes and bring an older database up to date"""
+    conn.executescript(TABLES)
+    
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(review_chunks)")}
+    if "content_hash" not in columns:
+        conn.create_function("content_hash", 1, content_hash, deterministic=True)
+        conn.execute("ALTER TABLE review_chunks ADD COLUMN content_hash BLOB")
+        conn.execute("UPDATE review_chunks SET content_hash = content_hash(content) WHERE content IS NOT NULL")
+    
+    # Older chunkers stored repeated excerpts; keep the first copy so the unique index can be built
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'uq_review_chunks_hash'").fetchone():
+        conn.execute("""
+            DELETE FROM review_chunks
+            WHERE rowid NOT IN (SELECT MIN(rowid) FROM review_chunks GROUP BY review_id, aspect, content_hash)
+        """)
+    
+    conn.executescript(INDEXES)
+    conn.commit()
+
+def content_hash(text):
+    """8-byte digest of a chunk's text; review_chunks is unique on (review_id, aspect, content_hash)"""
+    return hashlib.blake2b(text.encode(), digest_size=8).digest()
+
+def cache_path(db_path):
+    """Cache database, next to db_path unless POLYRATINGS_CACHE_DB is set; it only holds rebuildable caches, so it stays out of git"""
+    return os.getenv("POLYRATINGS_CACHE_DB") or os.path.join(os.path.dirname(db_path), "cache.db")
+
+def prune_cache(conn, table, ttl, max_entries):
+    """Delete cache rows older than ttl seconds, then all but the newest max_entries"""
+    conn.execute(f"DELETE FROM {table} WHERE created_at < ?", (int(time.time()) - ttl,))
+    conn.execute(f"""
+        DELETE FROM {table}
+        WHERE rowid NOT IN (SELECT rowid FROM {table} ORDER BY created_at DESC, rowid DESC LIMIT ?)
+    """, (max_entries,))
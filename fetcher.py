@@ -1,109 +1,127 @@
 #!/usr/bin/env python3
 """
 Fetch professor data from PolyRatings API and store in SQLite with fuzzy name search
-Usage: python fetch.py [--all | --prof <id> | --stats | --rebuild-fuzzy]
+Usage: python fetch.py [--all | --update | --prof <id> | --stats | --rebuild-fuzzy]
 """
 
-import json
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import urllib.parse
-import sqlite3
-from datetime import datetime
+import atexit
+import db
+from datetime import datetime, timezone
 from pathlib import Path
 import time
+import threading
 import argparse
-          
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Statements reused across every professor in a run; sqlite3's statement cache keys on the SQL text
+SQL_INSERT_PROF = """
+    INSERT OR REPLACE INTO professors 
+    (id, first_name, last_name, department, overall_rating, 
+     material_clear, student_difficulties, num_evals)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+SQL_INSERT_COURSE = """
+    INSERT OR IGNORE INTO courses (code, department)
+    VALUES (?, ?)
+"""
+
+SQL_INSERT_REVIEW = """
+    INSERT OR REPLACE INTO reviews 
+    (id, professor_id, course_code, grade, grade_level, course_type,
+    rating_text, post_date)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+SQL_INSERT_LOG = """
+    INSERT INTO fetch_logs (action, status, message, professor_id, timestamp)
+    VALUES (?, ?, ?, ?, ?)
+"""
+
+class RateLimiter:
+    """Thread-safe token bucket: sustained `rate` requests per second with bursts up to `burst`"""
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def acquire(self):
+        """Block until a request may be sent"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                
+                wait = (1 - self.tokens) / self.rate
+            
+            time.sleep(wait)
+
 class PolyRatingsFetcher:
-    def __init__(self):
+    def __init__(self, rate=None, burst=1):
         self.base_url = "https://api-prod.polyratings.org"
         self.data_dir = Path("data")
         self.db_path = self.data_dir / "professors.db"
         self.delay = 0.5
         self.max_retries = 3
+        self.max_workers = 10  # concurrent professor requests during --all
+        # Requests per second across all workers; defaults to the old sequential pace of one request per delay
+        self.rate_limiter = RateLimiter(rate=rate if rate is not None else 1 / self.delay, burst=burst)
+        self.commit_every = 1000  # reviews written per transaction during --all
+        self.log_flush_size = 50  # buffered fetch_logs rows per executemany
+        
+        # Keep-alive connections shared by all requests; urllib3 retries with exponential backoff
+        self.session = requests.Session()
+        retry = Retry(
+            total=self.max_retries,
+            backoff_factor=self.delay,
+            status_forcelist=[429, 500, 502, 503, 504]
+        )
+        adapter = HTTPAdapter(pool_connections=self.max_workers, pool_maxsize=self.max_workers, max_retries=retry)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({"Accept-Encoding": "gzip", "User-Agent": "poly-ratings-llm fetcher"})
+        
+        # One connection for the whole run; worker threads only log, under db_lock
+        self.data_dir.mkdir(exist_ok=True)
+        self.conn = db.connect(self.db_path, check_same_thread=False, cached_statements=256)
+        self.db_lock = threading.RLock()
+        self._log_buf = []
+        atexit.register(self.close)  # keep buffered logs if the run exits early
         
         self.setup_database()
     
     def setup_database(self):
-        """Create data directory and initialize SQLite database"""
-        self.data_dir.mkdir(exist_ok=True)
-        
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.executescript("""
-            CREATE TABLE IF NOT EXISTS professors (
-                id TEXT PRIMARY KEY,
-                first_name TEXT,
-                last_name TEXT,
-                department TEXT,
-                overall_rating REAL,
-                material_clear REAL,
-                student_difficulties REAL,
-                num_evals INTEGER,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );
-            
-            CREATE TABLE IF NOT EXISTS courses (
-                code TEXT PRIMARY KEY,
-                name TEXT,
-                department TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );
-            
-            CREATE TABLE IF NOT EXISTS reviews (
-                id TEXT PRIMARY KEY,
-                professor_id TEXT,
-                course_code TEXT,
-                grade TEXT,
-                grade_level TEXT,
-                course_type TEXT,
-                rating_text TEXT,
-                post_date TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (professor_id) REFERENCES professors (id),
-                FOREIGN KEY (course_code) REFERENCES courses (code)
-            );
-            
-            CREATE TABLE IF NOT EXISTS fetch_logs (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                action TEXT,
-                status TEXT,
-                message TEXT,
-                professor_id TEXT,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );
-                             
-             CREATE TABLE IF NOT EXISTS review_chunks (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    review_id TEXT,
-                    aspect TEXT,
-                    content TEXT,
-                    sentiment TEXT,
-                    tokens_used INTEGER,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (review_id) REFERENCES reviews (id)
-                );
-                
-            CREATE VIRTUAL TABLE IF NOT EXISTS professors_fts USING fts5(
-                name, 
-                professor_id
-            );
-        """)
-        
-        # create index/ add others later
-        conn.execute("CREATE INDEX IF NOT EXISTS idx_chunks_review_aspect ON review_chunks(review_id, aspect);")
-
-        conn.commit()
-        conn.close()
+        """Initialize SQLite database"""
+        db.ensure_schema(self.conn)
         print("Database initialized")
     
-    def update_professor_fuzzy_search(self, prof_data):
-        """Update fuzzy name search table for a professor"""
+    def commit(self):
+        """Commit everything written since the last commit, including buffered logs"""
+        with self.db_lock:
+            self._flush_logs()
+            self.conn.commit()
+    
+    def close(self):
+        self.commit()
+        db.close(self.conn)
+        atexit.unregister(self.close)
+    
+    def update_professor_fuzzy_search(self, cursor, prof_data):
+        """Update fuzzy name search table for a professor on the caller's cursor and transaction"""
+        prof_id = prof_data.get('id')
+        
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            prof_id = prof_data.get('id')
             full_name = f"{prof_data.get('firstName', '')} {prof_data.get('lastName', '')}".strip()
             
             # Remove existing entry
@@ -115,9 +133,6 @@ class PolyRatingsFetcher:
                 VALUES (?, ?)
             """, (full_name, prof_id))
             
-            conn.commit()
-            conn.close()
-            
         except Exception as e:
             self.log_message(f"Fuzzy search update failed for {prof_id}: {e}", "WARN")
     
@@ -126,23 +141,28 @@ class PolyRatingsFetcher:
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         print(f"[{timestamp}] {level}: {message}")
         
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO fetch_logs (action, status, message, professor_id)
-            VALUES (?, ?, ?, ?)
-        """, ("fetch", level, message, professor_id))
-        conn.commit()
-        conn.close()
+        # Buffered and written in bulk; committed together with the surrounding data writes
+        logged_at = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")  # matches CURRENT_TIMESTAMP
+        with self.db_lock:
+            self._log_buf.append(("fetch", level, message, professor_id, logged_at))
+            if len(self._log_buf) >= self.log_flush_size:
+                self._flush_logs()
+    
+    def _flush_logs(self):
+        """Write buffered log rows on the open transaction"""
+        with self.db_lock:
+            if self._log_buf:
+                self.conn.executemany(SQL_INSERT_LOG, self._log_buf)
+                self._log_buf.clear()
     
     def get_professors_overview(self):
         """Get overview of all professors"""
         url = f"{self.base_url}/professors.all"
         
         try:
-            response = requests.get(url, timeout=30)
+            response = self.session.get(url, timeout=30)
             response.raise_for_status()
-            data = response.json()
+            data = orjson.loads(response.content)
             
             professors = data.get('result', {}).get('data', [])
             self.log_message(f"Retrieved overview of {len(professors)} professors")
@@ -153,104 +173,118 @@ class PolyRatingsFetcher:
             return None
     
     def store_professor_data(self, prof_data):
-        """Store professor and review data in SQLite"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        """Write professor and review data on the open transaction; the caller commits"""
+        # Looked up once instead of on every course and review
+        prof_id = prof_data.get('id')
+        department = prof_data.get('department', '')
         
-        try:
-            cursor.execute("""
-                INSERT OR REPLACE INTO professors 
-                (id, first_name, last_name, department, overall_rating, 
-                 material_clear, student_difficulties, num_evals)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                prof_data.get('id'),
-                prof_data.get('firstName', ''),
-                prof_data.get('lastName', ''),
-                prof_data.get('department', ''),
-                prof_data.get('overallRating'),
-                prof_data.get('materialClear'),
-                prof_data.get('studentDifficulties'),
-                prof_data.get('numEvals', 0)
-            ))
+        with self.db_lock:
+            # A savepoint undoes just this professor on failure, so the next commit never writes
+            # one half-stored; BEGIN first, or releasing the savepoint would commit on its own
+            if not self.conn.in_transaction:
+                self.conn.execute("BEGIN")
+            self.conn.execute("SAVEPOINT store_professor")
             
-            reviews_data = prof_data.get('reviews', {})
-            review_count = 0
-            
-            for course_code, course_reviews in reviews_data.items():
-                course_code = course_code.strip().upper()
+            try:
+                cursor = self.conn.cursor()
+                cursor.execute(SQL_INSERT_PROF, (
+                    prof_id,
+                    prof_data.get('firstName', ''),
+                    prof_data.get('lastName', ''),
+                    department,
+                    prof_data.get('overallRating'),
+                    prof_data.get('materialClear'),
+                    prof_data.get('studentDifficulties'),
+                    prof_data.get('numEvals', 0)
+                ))
                 
-                cursor.execute("""
-                    INSERT OR IGNORE INTO courses (code, department)
-                    VALUES (?, ?)
-                """, (course_code, prof_data.get('department', '')))
+                reviews_data = prof_data.get('reviews', {})
+                course_rows = []
+                review_rows = []
                 
-                for review in course_reviews:
-                    cursor.execute("""
-                    INSERT OR REPLACE INTO reviews 
-                    (id, professor_id, course_code, grade, grade_level, course_type,
-                    rating_text, post_date)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                """, (
-                    review.get('id'),
-                    prof_data.get('id'),
-                    course_code,
-                    review.get('grade', ''),
-                    review.get('gradeLevel', ''),
-                    review.get('courseType', ''),
-                    review.get('rating', ''),
-                    review.get('postDate', '')
-                ))
-                    review_count += 1
-            
-            conn.commit()
-            
-            # Update fuzzy search table
-            self.update_professor_fuzzy_search(prof_data)
-            
-            return review_count
+                for course_code, course_reviews in reviews_data.items():
+                    course_code = course_code.strip().upper()
+                    course_rows.append((course_code, department))
+                    review_rows.extend(
+                        (
+                            review.get('id'),
+                            prof_id,
+                            course_code,
+                            review.get('grade', ''),
+                            review.get('gradeLevel', ''),
+                            review.get('courseType', ''),
+                            review.get('rating', ''),
+                            review.get('postDate', '')
+                        )
+                        for review in course_reviews
+                    )
+                
+                cursor.executemany(SQL_INSERT_COURSE, course_rows)
+                cursor.executemany(SQL_INSERT_REVIEW, review_rows)
+                review_count = len(review_rows)
+                
+                # Update fuzzy search table
+                self.update_professor_fuzzy_search(cursor, prof_data)
+            except BaseException:
+                self.conn.execute("ROLLBACK TO store_professor")
+                self.conn.execute("RELEASE store_professor")
+                raise
             
-        except Exception as e:
-            conn.rollback()
-            raise e
-        finally:
-            conn.close()
+            self.conn.execute("RELEASE store_professor")
+        
+        return review_count
     
-    def get_professor_details(self, professor_id, retry_count=0):
-        """Get detailed data for specific professor and store in database"""
+    def fetch_professor(self, professor_id):
+        """Download detailed data for specific professor without storing it"""
         input_data = {"id": professor_id}
-        input_encoded = urllib.parse.quote(json.dumps(input_data))
+        input_encoded = urllib.parse.quote(orjson.dumps(input_data))
         url = f"{self.base_url}/professors.get?input={input_encoded}" # that is what the PolyRating API takes
         
         try:
-            response = requests.get(url, timeout=30)
+            response = self.session.get(url, timeout=30)
             response.raise_for_status()
-            data = response.json()
+            data = orjson.loads(response.content)
             
             prof_data = data.get('result', {}).get('data', {})
             if not prof_data:
                 self.log_message(f"No data returned for professor {professor_id}", "WARN", professor_id)
                 return None
             
-            review_count = self.store_professor_data(prof_data)
-            
-            prof_name = f"{prof_data.get('firstName', '')} {prof_data.get('lastName', '')}"
-            self.log_message(f"Stored {prof_name} ({review_count} reviews)", "SUCCESS", professor_id)
-            
             return prof_data
             
         except requests.exceptions.RequestException as e:
-            if retry_count < self.max_retries:
-                self.log_message(f"Retrying professor {professor_id} (attempt {retry_count + 1})", "WARN", professor_id)
-                time.sleep(self.delay * 2)
-                return self.get_professor_details(professor_id, retry_count + 1)
-            else:
-                self.log_message(f"Failed to fetch professor {professor_id}: {e}", "ERROR", professor_id)
-                return None
+            self.log_message(f"Failed to fetch professor {professor_id}: {e}", "ERROR", professor_id)
+            return None
+    
+    def save_professor(self, prof_data):
+        """Store fetched professor data and log the result"""
+        review_count = self.store_professor_data(prof_data)
+        
+        prof_name = f"{prof_data.get('firstName', '')} {prof_data.get('lastName', '')}"
+        self.log_message(f"Stored {prof_name} ({review_count} reviews)", "SUCCESS", prof_data.get('id'))
+        return review_count
+    
+    def get_professor_details(self, professor_id):
+        """Get detailed data for specific professor and store in database"""
+        prof_data = self.fetch_professor(professor_id)
+        if prof_data:
+            self.save_professor(prof_data)
+            self.commit()
+        return prof_data
+    
+    def _fetch_rate_limited(self, professor_id):
+        """Worker for fetch_all_professors: wait for the shared rate limit, then fetch one professor"""
+        self.rate_limiter.acquire()
+        return self.fetch_professor(professor_id)
+    
+    def get_stored_eval_counts(self):
+        """Map professor id to the number of evaluations currently stored"""
+        with self.db_lock:
+            return dict(self.conn.execute("SELECT id, num_evals FROM professors").fetchall())
     
-    def fetch_all_professors(self):
-        """Fetch and store data for all professors. Return true if there is not a single error"""
-        self.log_message("Starting complete data fetch...")
+    def fetch_all_professors(self, only_changed=False):
+        """Fetch and store data for all (or only new/changed) professors. Return true if there is not a single error"""
+        self.log_message("Starting incremental data fetch..." if only_changed else "Starting complete data fetch...")
         
         professors_overview = self.get_professors_overview()
         if not professors_overview:
@@ -264,26 +298,49 @@ class PolyRatingsFetcher:
             self.log_message("No professor IDs found", "ERROR")
             return False
         
+        if only_changed:
+            # The overview already carries numEvals, so unchanged professors need no detail request
+            stored_counts = self.get_stored_eval_counts()
+            professor_ids = [
+                prof.get('id') for prof in professors
+                if prof.get('id') and stored_counts.get(prof.get('id')) != prof.get('numEvals')
+            ]
+            self.log_message(f"Skipping {len(professors) - len(professor_ids)} unchanged professors")
+        
         self.log_message(f"Found {len(professor_ids)} professors to fetch")
         
         success_count = 0
         failed_count = 0
         failed_ids = []  
         total_reviews = 0
+        uncommitted = 0  # reviews written since the last commit
         
-        for i, prof_id in enumerate(professor_ids):
-            self.log_message(f"Progress: {i+1}/{len(professor_ids)} - Fetching {prof_id}")
-            
-            prof_data = self.get_professor_details(prof_id)
-            if prof_data:
-                success_count += 1
-                total_reviews += prof_data.get('numEvals', 0)
-            else:
-                failed_count += 1
-                failed_ids.append(prof_id)  # Store failed ID
+        # Requests run in worker threads; results are stored from this thread only
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self._fetch_rate_limited, prof_id): prof_id for prof_id in professor_ids}
             
-       
-            time.sleep(self.delay)
+            try:
+                for i, future in enumerate(as_completed(futures)):
+                    prof_id = futures[future]
+                    self.log_message(f"Progress: {i+1}/{len(professor_ids)} - Fetched {prof_id}")
+                    
+                    prof_data = future.result()
+                    if prof_data:
+                        uncommitted += self.save_professor(prof_data)
+                        success_count += 1
+                        total_reviews += prof_data.get('numEvals', 0)
+                        
+                        # One transaction (and fsync) per ~commit_every reviews instead of per professor
+                        if uncommitted >= self.commit_every:
+                            self.commit()
+                            uncommitted = 0
+                    else:
+                        failed_count += 1
+                        failed_ids.append(prof_id)  # Store failed ID
+            except BaseException:
+                # Don't keep fetching professors that will not be stored
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
         
         # Summary
         self.log_message(f"Fetch complete! Success: {success_count}, Failed: {failed_count}")
@@ -293,57 +350,44 @@ class PolyRatingsFetcher:
         if failed_ids:
             self.log_message(f"Failed professor IDs: {', '.join(failed_ids)}", "WARN")
         
+        self.commit()
         return failed_count == 0
     
     def rebuild_fuzzy_search(self):
         """Rebuild the fuzzy name search table from existing professors"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
         try:
-            # Clear existing fuzzy search data
-            cursor.execute("DELETE FROM professors_fts")
-            
-            # Rebuild from professors table
-            cursor.execute("SELECT id, first_name, last_name FROM professors")
-            professors = cursor.fetchall()
-            
-            for prof_id, first_name, last_name in professors:
-                full_name = f"{first_name} {last_name}".strip()
-                cursor.execute("""
-                    INSERT INTO professors_fts (name, professor_id) 
-                    VALUES (?, ?)
-                """, (full_name, prof_id))
+            with self.db_lock:
+                # Clear existing fuzzy search data
+                self.conn.execute("DELETE FROM professors_fts")
+                
+                # Rebuild from professors table in one statement, without a Python round-trip per row
+                cursor = self.conn.execute("""
+                    INSERT INTO professors_fts (name, professor_id)
+                    SELECT TRIM(COALESCE(first_name, '') || ' ' || COALESCE(last_name, '')), id
+                    FROM professors
+                """)
+                self.conn.commit()
             
-            conn.commit()
-            self.log_message(f"Fuzzy search rebuilt with {len(professors)} professors")
+            self.log_message(f"Fuzzy search rebuilt with {cursor.rowcount} professors")
             
         except Exception as e:
-            conn.rollback()
+            self.conn.rollback()
             self.log_message(f"Fuzzy search rebuild failed: {e}", "ERROR")
-        finally:
-            conn.close()
     
     def show_stats(self):
         """Show database statistics"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        cursor = self.conn.cursor()
         
-        # Counts
-        cursor.execute("SELECT COUNT(*) FROM professors")
-        prof_count = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM reviews")
-        review_count = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM courses")
-        course_count = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(DISTINCT department) FROM professors")
-        dept_count = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM professors_fts")
-        fts_count = cursor.fetchone()[0]
+        # Counts, in one round-trip
+        cursor.execute("""
+            SELECT
+                (SELECT COUNT(*) FROM professors),
+                (SELECT COUNT(*) FROM reviews),
+                (SELECT COUNT(*) FROM courses),
+                (SELECT COUNT(DISTINCT department) FROM professors),
+                (SELECT COUNT(*) FROM professors_fts)
+        """)
+        prof_count, review_count, course_count, dept_count, fts_count = cursor.fetchone()
         
         # within 24 hours
         cursor.execute("""
@@ -354,8 +398,6 @@ class PolyRatingsFetcher:
         """)
         recent_logs = cursor.fetchall()
         
-        conn.close()
-        
         print("\n=== Database Statistics ===")
         print(f"Professors: {prof_count}")
         print(f"Reviews: {review_count}")
@@ -370,21 +412,33 @@ class PolyRatingsFetcher:
         
         print(f"\nDatabase file: {self.db_path}")
 
+def positive_number(value):
+    """argparse type for --rate: a number greater than zero"""
+    number = float(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"must be greater than 0, got {value}")
+    return number
+
 def main():
     parser = argparse.ArgumentParser(description="Fetch PolyRatings professor data to SQLite")
     
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument('--all', action='store_true', help='Fetch all professors and reviews')
+    group.add_argument('--update', action='store_true', help='Fetch only new professors and those with new reviews')
     group.add_argument('--prof', type=str, metavar='ID', help='Fetch specific professor by ID')
     group.add_argument('--stats', action='store_true', help='Show database statistics')
     group.add_argument('--rebuild-fuzzy', action='store_true', help='Rebuild fuzzy name search for typos')
+    parser.add_argument('--rate', type=positive_number, metavar='N', help='Max requests per second to PolyRatings (default 2)')
+    parser.add_argument('--burst', type=int, default=1, metavar='N', help='Requests that may go out back to back after an idle spell (default 1)')
     
     args = parser.parse_args()
+    if args.burst < 1:
+        parser.error("argument --burst: must be at least 1")  # the bucket could never hold a whole request
     
-    fetcher = PolyRatingsFetcher()
+    fetcher = PolyRatingsFetcher(rate=args.rate, burst=args.burst)
     
-    if args.all:
-        success = fetcher.fetch_all_professors()
+    if args.all or args.update:
+        success = fetcher.fetch_all_professors(only_changed=args.update)
         if success:
             print("\nData fetch completed!")
             fetcher.show_stats()
@@ -404,6 +458,8 @@ def main():
     elif args.rebuild_fuzzy:
         fetcher.rebuild_fuzzy_search()
         print("Fuzzy name search rebuilt!")
+    
+    fetcher.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
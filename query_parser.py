@@ -3,21 +3,73 @@
 query_parser.py - Extract professor, course, department, and aspect from user queries
 """
 
+import asyncio
+import hashlib
 import json
-import sqlite3
-from openai import OpenAI
+import threading
+import time
+from collections import OrderedDict
+from openai import AsyncOpenAI
 import os
 from dotenv import load_dotenv
+import db
 
 load_dotenv()
 
+QUERY_CACHE_TTL = 30 * 24 * 3600  # seconds
+QUERY_CACHE_MAX_ENTRIES = 10000
+
 class QueryParser:
-    def __init__(self, db_path):
+    def __init__(self, db_path, client=None):
         self.db_path = db_path
-        self.client = OpenAI(api_key=os.getenv("OPEN_AI_API_KEY"))
+        # Pass the caller's client to share its keep-alive connection pool
+        self.client = client or AsyncOpenAI(api_key=os.getenv("OPEN_AI_API_KEY"))
+        self.max_concurrency = 8  # in-flight OpenAI requests in parse_queries
+        
+        # Name and course lookups from resolve_professor_course, run in worker threads; _lock keeps them one at a time
+        self._conn = db.connect(db_path, readonly=True, check_same_thread=False)
+        self._lock = threading.Lock()
+        
+        # Parsed queries persist across runs in the cache database; it is capped, so load it whole
+        self._cache_conn = db.connect(db.cache_path(db_path), check_same_thread=False)
+        self._cache_lock = threading.Lock()
+        with self._cache_lock, self._cache_conn as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS query_cache (hash TEXT PRIMARY KEY, result_json TEXT, created_at INTEGER)")
+            db.prune_cache(conn, "query_cache", QUERY_CACHE_TTL, QUERY_CACHE_MAX_ENTRIES)
+            # hash -> (created_at, parsed query), oldest first
+            self._query_cache = OrderedDict(
+                (key, (created_at, json.loads(result_json)))
+                for key, result_json, created_at in conn.execute(
+                    "SELECT hash, result_json, created_at FROM query_cache ORDER BY created_at, rowid"
+                )
+            )
+    
+    def _cache_key(self, query):
+        normalized = " ".join(query.lower().split())
+        return hashlib.blake2b(normalized.encode(), digest_size=16).hexdigest()
+    
+    def _get_cached(self, query):
+        entry = self._query_cache.get(self._cache_key(query))
+        if entry is None or entry[0] < time.time() - QUERY_CACHE_TTL:
+            return None
+        return dict(entry[1])
+    
+    def _cache_result(self, query, result):
+        key = self._cache_key(query)
+        created_at = int(time.time())
+        with self._cache_lock, self._cache_conn as conn:
+            self._query_cache[key] = (created_at, dict(result))
+            self._query_cache.move_to_end(key)
+            while len(self._query_cache) > QUERY_CACHE_MAX_ENTRIES:
+                self._query_cache.popitem(last=False)
+            
+            conn.execute("""
+                INSERT OR REPLACE INTO query_cache (hash, result_json, created_at) VALUES (?, ?, ?)
+            """, (key, json.dumps(result), created_at))
+            db.prune_cache(conn, "query_cache", QUERY_CACHE_TTL, QUERY_CACHE_MAX_ENTRIES)
     
-    def parse_query(self, query):
-        prompt = f"""Extract information from this professor review query. Return JSON only:
+    def _prompt(self, query):
+        return f"""Extract information from this professor review query. Return JSON only:
 
 Query: {query}
 
@@ -28,31 +80,53 @@ Extract:
 
 Return JSON:
 {{"professor": "...", "course": "...", "aspect": "..."}}"""
+    
+    def _request_body(self, query):
+        return {
+            "model": "gpt-4o-mini",
+            "messages": [{"role": "user", "content": self._prompt(query)}],
+            "temperature": 0.1,
+            "max_tokens": 200
+        }
+    
+    def _parse_response(self, response):
+        content = response.choices[0].message.content.strip()
+        if content.startswith('```json'):
+            content = content.replace('```json', '').replace('```', '').strip()
+        
+        result = json.loads(content)
+        
+        for key in result:
+            if result[key] == "null" or result[key] == "":
+                result[key] = None
+        
+        return result
+    
+    async def parse_query(self, query):
+        cached = self._get_cached(query)
+        if cached is not None:
+            return cached
         
         try:
-            response = self.client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[{"role": "user", "content": prompt}],
-                temperature=0.1,
-                max_tokens=200
-            )
-            
-            content = response.choices[0].message.content.strip()
-            if content.startswith('```json'):
-                content = content.replace('```json', '').replace('```', '').strip()
-            
-            result = json.loads(content)
-            
-            for key in result:
-                if result[key] == "null" or result[key] == "":
-                    result[key] = None
-            
+            response = await self.client.chat.completions.create(**self._request_body(query))
+            result = self._parse_response(response)
+            await asyncio.to_thread(self._cache_result, query, result)
             return result
             
         except Exception as e:
             print(f"Parse error: {e}")
             return {"professor": None, "course": None, "aspect": None}
     
+    async def parse_queries(self, queries):
+        """Parse several queries concurrently; results are in the same order as queries"""
+        sem = asyncio.Semaphore(self.max_concurrency)
+        
+        async def parse_one(query):
+            async with sem:
+                return await self.parse_query(query)
+        
+        return await asyncio.gather(*[parse_one(query) for query in queries])
+    
     def resolve_professor_course(self, parsed_query):
         """Find professor using fuzzy search"""
         result = {
@@ -68,18 +142,34 @@ Return JSON:
         if not query_prof:
             return result
         
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
+        tokens = query_prof.split()
+        
+        with self._lock:
+            cursor = self._conn.cursor()
+            match = None
             
-            # Simple FTS5 search
-            cursor.execute("""
-                SELECT professor_id, name 
-                FROM professors_fts 
-                WHERE professors_fts MATCH ?
-                LIMIT 1
-            """, (query_prof,))
+            # A clean "First Last" name is an indexed lookup; skip FTS for it
+            if len(tokens) == 2:
+                cursor.execute("""
+                    SELECT id, TRIM(first_name || ' ' || last_name)
+                    FROM professors
+                    WHERE last_name = ? COLLATE NOCASE AND first_name = ? COLLATE NOCASE
+                    LIMIT 1
+                """, (tokens[1], tokens[0]))
+                match = cursor.fetchone()
             
-            match = cursor.fetchone()
+            if not match and tokens:
+                # Quoted so punctuation in names can't break FTS syntax; last word may be partial
+                fts_query = " ".join('"' + token.replace('"', '""') + '"' for token in tokens) + "*"
+                cursor.execute("""
+                    SELECT professor_id, name 
+                    FROM professors_fts 
+                    WHERE professors_fts MATCH ?
+                    ORDER BY rank
+                    LIMIT 1
+                """, (fts_query,))
+                
+                match = cursor.fetchone()
             
             if match:
                 prof_id, matched_name = match
@@ -89,15 +179,20 @@ Return JSON:
                 
                 if query_course:
                     cursor.execute("""
-                        SELECT DISTINCT course_code 
+                        SELECT 1
                         FROM reviews 
-                        WHERE professor_id = ? AND UPPER(course_code) = UPPER(?)
+                        WHERE professor_id = ? AND course_code = ? COLLATE NOCASE
+                        LIMIT 1
                     """, (prof_id, query_course))
                     
                     if cursor.fetchone():
                         result["course_code"] = query_course.upper()
         
         return result
+    
+    def close(self):
+        self._conn.close()
+        self._cache_conn.close()
 
 def main():
     parser = QueryParser("data/professors.db")
@@ -109,14 +204,18 @@ def main():
         "Tell me about Hugh Smith"
     ]
     
-    for query in test_queries:
-        parsed = parser.parse_query(query)
+    # All demo queries go to OpenAI at once instead of one after another
+    parsed_queries = asyncio.run(parser.parse_queries(test_queries))
+    
+    for query, parsed in zip(test_queries, parsed_queries):
         resolved = parser.resolve_professor_course(parsed)
         
         print(f"Query: {query}")
         print(f"Parsed: {parsed}")
         print(f"Resolved: {resolved}")
         print("-" * 50)
+    
+    parser.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -3,47 +3,131 @@
 retriever.py - Simple chunk retrieval for professor reviews
 """
 
+import os
+import re
 import sqlite3
+import threading
+import db
+
+# A full scan of one of the real tables in the chunk queries (aliases rc, r and p)
+_TABLE_SCAN_RE = re.compile(r"SCAN (rc|r|p)\b")
+
+def _chunks_sql(with_aspect, with_course):
+    """Chunk SELECT: chunks of the requested aspect first, topped up with 'overall' ones, newest first"""
+    query = f"""
+        SELECT rc.aspect, rc.content, rc.sentiment, r.course_code, rc.created_at,
+               {"rc.aspect = ?" if with_aspect else "0"} AS preferred
+        FROM review_chunks rc
+        JOIN reviews r ON rc.review_id = r.id
+        WHERE r.professor_id = ?
+    """
+    if with_aspect:
+        query += " AND rc.aspect IN (?, 'overall')"
+    if with_course:
+        query += " AND r.course_code = ? COLLATE NOCASE"
+    return query + " ORDER BY preferred DESC, rc.created_at DESC LIMIT ?"
+
+def _with_prof_sql(chunks_sql):
+    """Wrap a chunk SELECT so the professor row comes back with it"""
+    # Professor columns repeat on every row; a professor without chunks comes back as one row of NULL chunk columns
+    return f"""
+        SELECT p.first_name, p.last_name, p.department, p.overall_rating,
+               p.material_clear, p.student_difficulties, p.num_evals,
+               c.aspect, c.content, c.sentiment, c.course_code
+        FROM professors p
+        LEFT JOIN ({chunks_sql}) c ON 1
+        WHERE p.id = ?
+        ORDER BY c.preferred DESC, c.created_at DESC
+    """
 
 class ChunkRetriever:
+    # Every SQL text is fixed up front, so each call hits sqlite3's statement cache
+    _SQL_BASE = _chunks_sql(False, False)
+    _SQL_ASPECT = _chunks_sql(True, False)
+    _SQL_COURSE = _chunks_sql(False, True)
+    _SQL_BOTH = _chunks_sql(True, True)
+    
+    # Keyed by (aspect given, course given)
+    _CHUNK_SQL = {(False, False): _SQL_BASE, (True, False): _SQL_ASPECT, (False, True): _SQL_COURSE, (True, True): _SQL_BOTH}
+    _PROF_SQL = {key: _with_prof_sql(sql) for key, sql in _CHUNK_SQL.items()}
+    
     def __init__(self, db_path):
         self.db_path = db_path
+        # One read-only connection for every request's chunk query, so its statement cache stays warm; _lock guards it
+        self._conn = db.connect(db_path, readonly=True, check_same_thread=False, cached_statements=256)
+        self._conn.row_factory = sqlite3.Row  # chunks are read by column name; no dict per row
+        self._lock = threading.Lock()
+        
+        if os.getenv("POLYRATINGS_DEBUG"):
+            self._check_query_plan()
+    
+    def close(self):
+        self._conn.close()
+    
+    def check(self):
+        """Run a trivial query to confirm the database is reachable"""
+        with self._lock:
+            self._conn.execute("SELECT 1 FROM professors LIMIT 1").fetchone()
+    
+    def _check_query_plan(self):
+        """Raise if a chunk query variant falls back to a full table scan (e.g. after a schema change drops an index)"""
+        for aspect in (None, "overall"):
+            for course_code in (None, "CSC 101"):
+                query, params = self._chunks_query("", aspect, course_code)
+                key = (bool(aspect), bool(course_code))
+                # get_chunks_with_prof serves the app; its "SCAN c" only walks the few materialized chunk rows
+                for sql, sql_params in ((query, params), (self._PROF_SQL[key], params + [""])):
+                    plan = [row[3] for row in self._conn.execute("EXPLAIN QUERY PLAN " + sql, sql_params)]
+                    if any(_TABLE_SCAN_RE.match(detail) for detail in plan):
+                        raise RuntimeError(f"Chunk query is not using an index (aspect={aspect}, course_code={course_code}): {plan}")
+    
+    def _chunks_query(self, professor_id, aspect=None, course_code=None, limit=10):
+        """Pick the chunk SELECT for the given filters and build its params"""
+        params = [aspect, professor_id, aspect] if aspect else [professor_id]
+        if course_code:
+            params.append(course_code)
+        params.append(limit)
+        
+        return self._CHUNK_SQL[(bool(aspect), bool(course_code))], params
 
     def get_chunks(self, professor_id, aspect=None, course_code=None, limit=10):
-        """Get chunks for a professor, optionally filtered by aspect and course"""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            
-            query = """
-                SELECT rc.aspect, rc.content, rc.sentiment, r.course_code
-                FROM review_chunks rc
-                JOIN reviews r ON rc.review_id = r.id
-                WHERE r.professor_id = ?
-            """
-            params = [professor_id]
-            
-            if aspect:
-                query += " AND rc.aspect = ?"
-                params.append(aspect)
-            
-            if course_code:
-                query += " AND UPPER(r.course_code) = UPPER(?)"
-                params.append(course_code)
-            
-            query += " ORDER BY rc.created_at DESC LIMIT ?"
-            params.append(limit)
-            
-            cursor.execute(query, params)
-            rows = cursor.fetchall()
-            
-            return [{"aspect": row[0], "content": row[1], "sentiment": row[2], "course_code": row[3]} 
-                   for row in rows]
+        """Get chunks for a professor, optionally preferring an aspect and filtered by course"""
+        query, params = self._chunks_query(professor_id, aspect, course_code, limit)
+        
+        with self._lock:
+            return self._conn.execute(query, params).fetchall()
+
+    def get_chunks_with_prof(self, professor_id, aspect=None, course_code=None, limit=10):
+        """Get professor info and chunks in one query. Returns (prof_info or None, chunks)"""
+        _, chunks_params = self._chunks_query(professor_id, aspect, course_code, limit)
+        query = self._PROF_SQL[(bool(aspect), bool(course_code))]
+        params = chunks_params + [professor_id]
+        
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        
+        if not rows:
+            return None, []
+        
+        row = rows[0]
+        prof_info = {
+            "name": f"{row['first_name']} {row['last_name']}",
+            "department": row["department"],
+            "overall_rating": row["overall_rating"],
+            "material_clear": row["material_clear"],
+            "student_difficulties": row["student_difficulties"],
+            "num_evals": row["num_evals"]
+        }
+        # Rows also carry the professor columns; callers only read the chunk ones by name
+        chunks = [row for row in rows if row["content"] is not None]
+        
+        return prof_info, chunks
 
 def main():
     retriever = ChunkRetriever("data/professors.db")
 
     for c in retriever.get_chunks("975ae5ae-66f6-4238-b431-bf0068ff2fad", course_code="CSC 349"):
-        print(c)
+        print(dict(c))
         print()
 
 
@@ -3,161 +3,244 @@
 synthesizer.py - Generate professor summaries using chunked reviews and OpenAI API
 """
 
-import sqlite3
-from openai import OpenAI
+import asyncio
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+from openai import AsyncOpenAI
 import os
 from dotenv import load_dotenv
 from query_parser import QueryParser
 from retriever import ChunkRetriever
+import db
 
 load_dotenv()
 
+STATS_KEYS = ("overall_rating", "material_clear", "student_difficulties", "num_evals")
+RESOLVED_CACHE_MAX_ENTRIES = 4096
+MAX_QUERY_LENGTH = 100  # also enforced on the API's QueryRequest
+SUMMARY_CACHE_TTL = 7 * 24 * 3600  # seconds
+SUMMARY_CACHE_MAX_ENTRIES = 5000
+
+# A question about a professor needs at least one letter; anything else is rejected before parsing
+_LETTER_RE = re.compile(r"[^\W\d_]")
+
 class ProfessorSynthesizer:
     def __init__(self, db_path):
         self.db_path = db_path
-        self.client = OpenAI(api_key=os.getenv("OPEN_AI_API_KEY"))
-        self.parser = QueryParser(db_path)
+        # One client, and so one pool of warm HTTPS connections, for both the parse and summary calls
+        self.client = AsyncOpenAI(api_key=os.getenv("OPEN_AI_API_KEY"))
+        self.parser = QueryParser(db_path, client=self.client)
         self.retriever = ChunkRetriever(db_path)
-        
-    def get_numerical_professor_info(self, professor_id):
-        """Get basic professor information and numerical ratings"""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            
-            cursor.execute("""
-                SELECT first_name, last_name, department, overall_rating,
-                       material_clear, student_difficulties, num_evals
-                FROM professors 
-                WHERE id = ?
-            """, (professor_id,))
-            
-            row = cursor.fetchone()
-            if not row:
-                return None
-                
-            return {
-                "name": f"{row[0]} {row[1]}",
-                "department": row[2],
-                "overall_rating": row[3],
-                "material_clear": row[4],
-                "student_difficulties": row[5],
-                "num_evals": row[6]
-            }
+        self._resolved_cache = OrderedDict()  # normalized query -> resolved professor/course/aspect, LRU order
+        
+        # Answers keyed by a hash of the full prompt, so new reviews or a different question miss.
+        # They live in the cache database with the parsed queries, not in professors.db
+        self._cache_conn = db.connect(db.cache_path(db_path), check_same_thread=False)
+        self._cache_lock = threading.Lock()
+        with self._cache_lock, self._cache_conn as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS summary_cache (
+                    prompt_hash BLOB PRIMARY KEY,
+                    answer TEXT,
+                    tokens INTEGER,
+                    created_at INTEGER
+                )
+            """)
+            db.prune_cache(conn, "summary_cache", SUMMARY_CACHE_TTL, SUMMARY_CACHE_MAX_ENTRIES)
     
-    def process_query(self, user_query):
-        """Main pipeline: parse -> resolve -> get chunks -> generate answer"""
+    def close(self):
+        self._cache_conn.close()
+        self.retriever.close()
+        self.parser.close()
+        
+    def check_database(self):
+        """Confirm the database is reachable on the connection that serves queries"""
+        self.retriever.check()
+    
+    def _resolved_key(self, user_query):
+        return " ".join(user_query.lower().split())
+    
+    def _get_resolved(self, user_query):
+        """Return a copy of the cached resolution for this query, or None"""
+        key = self._resolved_key(user_query)
+        resolved = self._resolved_cache.get(key)
+        if resolved is None:
+            return None
+        
+        self._resolved_cache.move_to_end(key)
+        return dict(resolved)  # callers add original_query; keep the cached entry clean
+    
+    def _cache_resolved(self, user_query, resolved):
+        key = self._resolved_key(user_query)
+        self._resolved_cache[key] = dict(resolved)
+        self._resolved_cache.move_to_end(key)
+        while len(self._resolved_cache) > RESOLVED_CACHE_MAX_ENTRIES:
+            self._resolved_cache.popitem(last=False)
+    
+    async def _retrieve(self, user_query):
+        """Parse -> resolve -> get chunks. Returns (early_response, prof_info, chunks, resolved); early_response ends the query"""
         
-        parsed = self.parser.parse_query(user_query)
-        print(f"Parsed query: {parsed}")
+        query = user_query.strip()
+        if len(query) < 3 or len(query) > MAX_QUERY_LENGTH or not _LETTER_RE.search(query):
+            return {"error": "Invalid query: ask a question about a professor"}, None, None, None
         
-        resolved_prof_course = self.parser.resolve_professor_course(parsed)
-        print(f"Resolved: {resolved_prof_course}")
+        resolved_prof_course = self._get_resolved(user_query)
         
-        if not resolved_prof_course["professor_id"]:
-            return {"error": "Professor not found in database"}, 0
+        if resolved_prof_course is None:
+            parsed = await self.parser.parse_query(user_query)
+            print(f"Parsed query: {parsed}")
+            
+            # SQLite calls block, so they run in worker threads while other queries wait on OpenAI
+            resolved_prof_course = await asyncio.to_thread(self.parser.resolve_professor_course, parsed)
+            print(f"Resolved: {resolved_prof_course}")
+            
+            if not resolved_prof_course["professor_id"]:
+                return {"error": "Professor not found in database"}, None, None, None
+            
+            self._cache_resolved(user_query, resolved_prof_course)
         
         resolved_prof_course["original_query"] = user_query
 
-        prof_info = self.get_numerical_professor_info(resolved_prof_course["professor_id"])
-        if not prof_info:
-            return {"error": "Professor information not available"}, 0
-        
-        chunks = self.retriever.get_chunks(
+        # Professor stats and chunks come back from a single query
+        prof_info, chunks = await asyncio.to_thread(
+            self.retriever.get_chunks_with_prof,
             resolved_prof_course["professor_id"], 
             resolved_prof_course["aspect"], 
             resolved_prof_course["course_code"], 
             limit=10
         )
+        if not prof_info:
+            return {"error": "Professor information not available"}, None, None, None
         
         if not chunks:
-            response_data = {
-                "professor": prof_info,
-                "stats": {
-                    "overall_rating": prof_info["overall_rating"],
-                    "material_clear": prof_info["material_clear"],
-                    "student_difficulties": prof_info["student_difficulties"],
-                    "num_evals": prof_info["num_evals"]
-                },
-                "excerpts": [],
-                "analysis": "No Review Excerpts found for this query."
-            }
-            return response_data, 0
+            return self._build_response(prof_info, chunks, "No Review Excerpts found for this query."), None, None, None
+        
+        return None, prof_info, chunks, resolved_prof_course
+    
+    async def process_query(self, user_query):
+        """Main pipeline: parse -> resolve -> get chunks -> generate answer"""
+        early_response, prof_info, chunks, resolved_prof_course = await self._retrieve(user_query)
+        if early_response:
+            return early_response, 0
                 
-        response_data, tokens_used = self.generate_summary(prof_info, chunks, resolved_prof_course)
+        response_data, tokens_used = await self.generate_summary(prof_info, chunks, resolved_prof_course)
         
         return response_data, tokens_used
     
-    def filter_chunks_by_aspect(self, chunks, target_aspect):
-        """Filter chunks by aspect, fallback to 'overall' if no matches found"""
-        if not target_aspect:
-            return chunks
+    async def process_query_stream(self, user_query):
+        """Streaming process_query: yields the response without "analysis" first, then {"delta": text} pieces of it"""
+        early_response, prof_info, chunks, resolved_prof_course = await self._retrieve(user_query)
+        if early_response:
+            yield early_response
+            return
         
-        matching_chunks = [chunk for chunk in chunks if chunk['aspect'].lower() == target_aspect.lower()]
+        yield self._build_response(prof_info, chunks)
         
-        if matching_chunks:
-            return matching_chunks
+        prompt = self._build_prompt(prof_info, chunks, resolved_prof_course)
+        prompt_hash = hashlib.blake2b(prompt.encode(), digest_size=16).digest()
         
-        overall_chunks = [chunk for chunk in chunks if chunk['aspect'].lower() == 'overall']
+        cached = await asyncio.to_thread(self._get_cached_summary, prompt_hash)
+        if cached is not None:
+            yield {"delta": cached}
+            return
         
-        if overall_chunks:
-            return overall_chunks
+        parts = []
+        total_tokens = 0
         
-        return None
-    
-    def generate_summary(self, prof_info, chunks, resolved):
-        """Generate answer using chunks and professor info"""
+        try:
+            stream = await self.client.chat.completions.create(
+                **self._request_body(prompt), stream=True, stream_options={"include_usage": True}
+            )
+            async for event in stream:
+                if event.usage:
+                    total_tokens = event.usage.total_tokens
+                if event.choices and event.choices[0].delta.content:
+                    parts.append(event.choices[0].delta.content)
+                    yield {"delta": event.choices[0].delta.content}
+                    
+        except Exception as e:
+            yield {"error": f"Error generating answer: {e}"}
+            return
         
-        filtered_chunks = self.filter_chunks_by_aspect(chunks, resolved["aspect"])
-        
-        if not filtered_chunks:
-            response_data = {
-                "professor": prof_info,
-                "stats": {
-                    "overall_rating": prof_info["overall_rating"],
-                    "material_clear": prof_info["material_clear"],
-                    "student_difficulties": prof_info["student_difficulties"],
-                    "num_evals": prof_info["num_evals"]
-                },
-                "excerpts": [],
-                "analysis": "No specific review excerpts available for this query."
-            }
-            return response_data, 0
-        
-        prompt = f"""Based on the following student review excerpts about Professor {prof_info['name']} from {prof_info['department']} department, answer this question: "{resolved.get('original_query', 'Tell me about this professor?')}"
+        answer_text = "".join(parts).strip()
+        if answer_text:
+            await asyncio.to_thread(self._cache_summary, prompt_hash, answer_text, total_tokens)
+    
+    async def process_queries_batch(self, queries):
+        """Answer several queries concurrently; returns (response, tokens_used) pairs in the same order"""
+        return await asyncio.gather(*[self.process_query(query) for query in queries])
+    
+    def _get_cached_summary(self, prompt_hash):
+        with self._cache_lock:
+            cached = self._cache_conn.execute(
+                "SELECT answer FROM summary_cache WHERE prompt_hash = ? AND created_at >= ?",
+                (prompt_hash, int(time.time()) - SUMMARY_CACHE_TTL)
+            ).fetchone()
+        return cached[0] if cached else None
+    
+    def _cache_summary(self, prompt_hash, answer_text, tokens):
+        with self._cache_lock, self._cache_conn as conn:
+            conn.execute("""
+                INSERT OR REPLACE INTO summary_cache (prompt_hash, answer, tokens, created_at)
+                VALUES (?, ?, ?, ?)
+            """, (prompt_hash, answer_text, tokens, int(time.time())))
+            db.prune_cache(conn, "summary_cache", SUMMARY_CACHE_TTL, SUMMARY_CACHE_MAX_ENTRIES)
+    
+    def _build_response(self, prof_info, chunks, analysis=None):
+        """Assemble the response dict; analysis is left out when it is streamed separately"""
+        response_data = {
+            "professor": prof_info,
+            "stats": {key: prof_info[key] for key in STATS_KEYS},
+            "excerpts": [{"aspect": chunk["aspect"], "content": chunk["content"]} for chunk in chunks]
+        }
+        if analysis is not None:
+            response_data["analysis"] = analysis
+        return response_data
+    
+    def _build_prompt(self, prof_info, chunks, resolved):
+        header = f"""Based on the following student review excerpts about Professor {prof_info['name']} from {prof_info['department']} department, answer this question: "{resolved.get('original_query', 'Tell me about this professor?')}"
 
 Student Review Excerpts:
 """
         
-        for chunk in filtered_chunks:
-            prompt += f"- [{chunk['aspect']}] {chunk['content']}\n"
+        return header + "".join(f"- [{chunk['aspect']}] {chunk['content']}\n" for chunk in chunks)
+    
+    def _request_body(self, prompt):
+        return {
+            "model": "gpt-4o-mini",
+            "messages": [{"role": "user", "content": prompt}],
+            "temperature": 0.3,
+            "max_tokens": 300,
+            "timeout": 30
+        }
+    
+    async def generate_summary(self, prof_info, chunks, resolved):
+        """Generate answer using chunks and professor info"""
+        
+        prompt = self._build_prompt(prof_info, chunks, resolved)
+        prompt_hash = hashlib.blake2b(prompt.encode(), digest_size=16).digest()
+        
+        cached = await asyncio.to_thread(self._get_cached_summary, prompt_hash)
+        
+        if cached is not None:
+            # Nothing was spent on OpenAI for this answer
+            answer_text, total_tokens = cached, 0
+        else:
+            try:
+                response = await self.client.chat.completions.create(**self._request_body(prompt))
                 
-        try:
-            response = self.client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[{"role": "user", "content": prompt}],
-                temperature=0.3,
-                max_tokens=300,
-                timeout=30
-            )
-            
-            answer_text = response.choices[0].message.content.strip()
-            
-            token_usage = response.usage
-            total_tokens = token_usage.total_tokens
-            
-            response_data = {
-                "professor": prof_info,
-                "stats": {
-                    "overall_rating": prof_info["overall_rating"],
-                    "material_clear": prof_info["material_clear"],
-                    "student_difficulties": prof_info["student_difficulties"],
-                    "num_evals": prof_info["num_evals"]
-                },
-                "excerpts": [{"aspect": chunk["aspect"], "content": chunk["content"]} for chunk in filtered_chunks],
-                "analysis": answer_text
-            }
-            
-            return response_data, total_tokens
+                answer_text = response.choices[0].message.content.strip()
+                
+                token_usage = response.usage
+                total_tokens = token_usage.total_tokens
+                
+            except Exception as e:
+                return {"error": f"Error generating answer: {e}"}, 0
             
-        except Exception as e:
-            return {"error": f"Error generating answer: {e}"}, 0
\ No newline at end of file
+            if answer_text:
+                await asyncio.to_thread(self._cache_summary, prompt_hash, answer_text, total_tokens)
+        
+        return self._build_response(prof_info, chunks, answer_text), total_tokens
\ No newline at end of file